@@ -16,19 +16,36 @@ https://github.com/feathered-hwang/lines2anki
 """
 
 
-# set up logging to file - see previous section for more details
 import logging
 import os
 import sys
-
-
-logging.basicConfig(level=logging.DEBUG,
-                    format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
-                    datefmt='%m-%d %H:%M',
-                    filename=os.path.dirname(sys.modules[__name__].__file__) + '/logger.log',
-                    filemode='w')
-# print the module's directory
-logging.info(os.path.dirname(sys.modules[__name__].__file__))
+from logging.handlers import RotatingFileHandler
+
+
+# The add-on logs through its package logger, so it neither depends on nor changes how the root logger is set up
+logger = logging.getLogger(__name__)
+_is_logging_set_up = False
+
+
+def setup_logging():
+    """
+    Set up logging to file, on first use rather than at Anki startup
+    """
+    global _is_logging_set_up
+    if _is_logging_set_up:
+        return
+    _is_logging_set_up = True
+    # Append to the log, rotating it instead of truncating it every launch
+    handler = RotatingFileHandler(os.path.dirname(sys.modules[__name__].__file__) + '/logger.log',
+                                  maxBytes=1 << 20, backupCount=2)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
+                                           datefmt='%m-%d %H:%M'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+    # Keep records away from handlers of the root logger, which may write to stderr (shown as errors by Anki)
+    logger.propagate = False
+    # print the module's directory
+    logger.info(os.path.dirname(sys.modules[__name__].__file__))
 
 
 # import Lines Import... main module
@@ -41,4 +58,5 @@ from . import importation
 try:
     from .testing import test
 except ImportError:
-    logging.info("test module doesn't exist.")
+    # test module doesn't exist.
+    pass
@@ -8,12 +8,16 @@
 
 import json
 import logging
+import mmap
 import random
 import re
+import tempfile
 import time
 import unicodedata
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from enum import IntEnum
 from pathlib import Path
-from shutil import copyfile
+from shutil import copyfile, copyfileobj, rmtree
 
 # import the main window object (mw) from aqt
 from aqt import mw, editor
@@ -26,6 +30,10 @@ from anki import notes
 
 # import ui
 from . import settingsDialog
+from . import setup_logging
+
+
+logger = logging.getLogger(__name__)
 
 
 # Support the same media types as the Editor
@@ -35,25 +43,113 @@ IMAGE_TYPES = editor.pics
 # TODO Add support to other lyric types
 SUB_TYPES = ("lrc", "txt",)
 
-# Field Map Choices
-FILL_NOTHING = ''
-FILL_FILENAME = 'File Name'
-FILL_PROV = 'Provenance'
-FILL_AUDIO = 'Audio'
-FILL_LINE = 'Subtitle'
-FILL_IMAGE = 'Random Image'
-FILLING_OPTIONS = [FILL_NOTHING,
-                   FILL_FILENAME,
-                   FILL_PROV,
-                   FILL_AUDIO,
-                   FILL_LINE,
-                   FILL_IMAGE]
+
+class Fill(IntEnum):
+    """
+    Field Map Choices, valued by their index in the combo boxes (and in the saved fieldMap)
+    """
+    NOTHING = 0
+    FILENAME = 1
+    PROV = 2
+    AUDIO = 3
+    LINE = 4
+    IMAGE = 5
+
+    @classmethod
+    def from_index(cls, option_idx):
+        """
+        Get the choice at option_idx, where -1 (no item selected) means NOTHING
+        """
+        return cls(option_idx) if option_idx >= 0 else cls.NOTHING
+
+
+# Labels of Field Map Choices, in order of their values
+FILLING_OPTIONS = ['',
+                   'File Name',
+                   'Provenance',
+                   'Audio',
+                   'Subtitle',
+                   'Random Image']
+
+# Settings loaded during this session, reused while the file's mtime is unchanged
+_SETTINGS_CACHE = {'path': None, 'mtime': None, 'data': None}
+
+# Lyric timestamps such as [01:23.45], and runs of line breaks in any convention
+_LRC_TS_RE = re.compile(r'\[[\d:.]+\]')
+_NEWLINES_RE = re.compile(r'(?:\r\n?|\n)+')
+# Subtitle files from this size on are decoded from a memory map
+_MMAP_MIN_SIZE = 1 << 14
+
+# Buffer size for copying media before Python 3.8, much larger than the default of shutil.copyfileobj
+_COPY_BUFSIZE = 1 << 18
+
+
+class _LazyJson:
+    """
+    Stand-in for the JSON text of obj in logging arguments, serialized only if the record gets emitted
+    """
+
+    def __init__(self, obj, **kwargs):
+        self.obj = obj
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return json.dumps(self.obj, **self.kwargs)
+
+
+def _is_settings_cached(path):
+    """
+    Tell whether the cached settings are still those stored in the file at path
+    """
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return False
+    return _SETTINGS_CACHE['path'] == path and _SETTINGS_CACHE['mtime'] == mtime
+
+
+def _fast_copy(src, dst):
+    """
+    Copy the contents of src to dst.
+    Since Python 3.8 copyfile has fast paths of its own (sendfile, fcopyfile, a 1 MiB buffer on Windows);
+    before that, copy within the kernel on Linux, otherwise through a large buffer.
+    """
+    if sys.version_info >= (3, 8):
+        copyfile(src, dst)
+        return
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        if sys.platform.startswith('linux'):
+            size = os.fstat(fsrc.fileno()).st_size
+            offset = 0
+            while offset < size:
+                sent = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, size - offset)
+                if not sent:
+                    raise OSError('Short copy of %s: %d of %d bytes' % (src, offset, size))
+                offset += sent
+        else:
+            copyfileobj(fsrc, fdst, _COPY_BUFSIZE)
+
+
+def _read_subtitle(path):
+    """
+    Read the subtitle file at path, with timestamps stripped
+    """
+    # Opening with utf-8-sig encoding, which will remove BOM (Byte order mark) if it exists
+    if os.path.getsize(path) < _MMAP_MIN_SIZE:
+        with open(path, mode='r', encoding='utf-8-sig') as f:
+            # Strip timestamps line by line rather than on a copy of the whole file
+            return ''.join(_LRC_TS_RE.sub('', ln) for ln in f)
+    # Decode larger files straight from the mapped pages, without reading them into a buffer first.
+    # Line breaks are left untranslated here, hence _NEWLINES_RE accepts \r\n and \r too.
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return _LRC_TS_RE.sub('', str(mm, 'utf-8-sig'))
 
 
 def do_import():
     """
     Get the user settings from settingsForm, then do importing
     """
+    setup_logging()
     # Raise the settings window for the add-on and retrieve its result when closed.
     (dir_path, prov, deck_name, model_name, field_map, tags, ok) = SettingsDialog().get_result()
     if not ok:
@@ -63,108 +159,160 @@ def do_import():
     model = mw.col.models.byName(model_name)
 
     # Initialize
-    audio_files, std_image_files, sub_files = [], [], []
+    audio_files, std_image_files = [], []
+    # Map each subtitle's file root to its extension
+    sub_files = {}
     is_import_failed = False
     card_count = 0
+    # Subtitles and images are only worth reading if some field is filled with them
+    field_fills = {field: Fill.from_index(option_idx) for field, option_idx in field_map.items()}
+    needs_line = Fill.LINE in field_fills.values()
+    needs_image = Fill.IMAGE in field_fills.values()
     # Locate work directory
     os.chdir(dir_path)
     # Firstly, get new file name standard prefix according to provenance
     std_prefix = prov.replace(' ', '.')
+    # Stamp every file of this import with the same id, telling files apart by index
+    batch_id = str(int(time.time()))
     # We won't walk the path - we only want the top-level files.
-    file_names = os.listdir(dir_path)
-
-    # Start importing progress
-    mw.progress.start(max=len(file_names), parent=mw)
-    p = 0
-
-    # To classify files
-    for f in file_names:
-        file_root, ext = os.path.splitext(f)
-        _ext = ext[1:].lower()
-        if _ext in AUDIO_TYPES:
-            audio_files.append((file_root, ext))
-        elif _ext in SUB_TYPES:
-            sub_files.append((file_root, ext))
-        elif _ext in IMAGE_TYPES:
-            # Copy image files to collection.media with standardized name
-            std_name = std_prefix + '.image-' + str(time.time()) + ext
-            copyfile(f, std_name)
-            std_image_files.append(std_name)
-            p += 1
-        else:
-            p += 1
-        # Update progress
-        mw.progress.update(value=p)
-
-    # Create a note for each audio file, and add it to Anki collection
-    for i, (root, ext) in enumerate(audio_files):
-        std_root = std_prefix + '.audio' + '(' + str(i + 1) + ')' + '-' + str(time.time())
-        std_name = std_root + ext
-        copyfile(root + ext, std_name)
-        mw.col.media.addFile(std_name)
-        os.remove(std_name)
-
-        # Create a new note
-        note = notes.Note(mw.col, model)
-        note.model()['did'] = deck['id']
-
-        # Get subtitle file content
+    # DirEntry.is_file() answers from the directory listing itself, so only symlinks cost a stat.
+    with os.scandir(dir_path) as it:
+        entries = [e for e in it if e.is_file()]
+
+    # Standardized image copies are staged in a temporary directory, removed as a whole at the end,
+    # however the import ends. It is only needed if some field is filled with images.
+    staging_dir = tempfile.mkdtemp(prefix='lines2anki-') if needs_image else None
+    try:
+        # Start importing progress
+        mw.progress.start(max=len(entries), parent=mw)
+        p = 0
+        # Repaint the progress bar about 200 times at most, rather than for every file
+        progress_step = max(1, len(entries) // 200)
+        last_p = 0
+
+        def update_progress():
+            nonlocal last_p
+            if p - last_p >= progress_step:
+                mw.progress.update(value=p)
+                last_p = p
+
+        # To classify files, while image copies run in the background
+        image_copies = []
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            for entry in entries:
+                file_root, dot, _ext = entry.name.rpartition('.')
+                # As with os.path.splitext, a name without any dot, or with no dot but leading
+                # dots (a hidden file such as .lrc) has no extension
+                ext = dot + _ext
+                _ext = _ext.lower() if file_root.lstrip('.') else ''
+                if _ext in AUDIO_TYPES:
+                    audio_files.append((file_root, ext))
+                elif _ext in SUB_TYPES:
+                    sub_files[file_root] = ext
+                elif _ext in IMAGE_TYPES and needs_image:
+                    # Copy image files to collection.media with standardized name
+                    std_name = os.path.join(
+                        staging_dir, std_prefix + '.image-' + batch_id + '.' + str(len(std_image_files) + 1) + ext)
+                    image_copies.append(executor.submit(_fast_copy, entry.name, std_name))
+                    std_image_files.append(std_name)
+                else:
+                    p += 1
+                    # Update progress
+                    update_progress()
+
+            # Wait for image copies, updating progress from this (the main) thread
+            for future in as_completed(image_copies):
+                # Re-raise any error from the copy
+                future.result()
+                p += 1
+                update_progress()
+
+        # Media names of the images added so far, as each image is added to media once however often it's chosen
+        added_images = {}
+
+        def random_image():
+            if not std_image_files:
+                return ''
+            image = random.choice(std_image_files)
+            if image not in added_images:
+                added_images[image] = mw.col.media.addFile(image)
+            return u'<img src="%s">' % added_images[image]
+
+        # Interpret the field map once for all notes, leaving out fields to fill nothing.
+        # Fillers read the current note's values (std_root, std_name, line) when called.
+        fillers = {
+            Fill.FILENAME: lambda: std_root,
+            Fill.PROV: lambda: prov,
+            Fill.AUDIO: lambda: u'[sound:%s]' % std_name,
+            Fill.LINE: lambda: line,
+            Fill.IMAGE: random_image,
+        }
+        field_fillers = [(field, fillers[fill]) for field, fill in field_fills.items() if fill != Fill.NOTHING]
+
+        # Commit pending changes first, so that all notes below go into the database in one transaction
+        mw.col.save()
         try:
-            # Find the corespondent sub file
-            sub_ext = sub_files[[r[0] for r in sub_files].index(root)][1]
-            # Opening with utf-8-sig encoding, which will remove BOM (Byte order mark) if it exists
-            with open(root + sub_ext, mode='r', encoding='utf-8-sig') as f:
-                line = re.sub(r'\[[0-9:.]+\]', '', f.read())
-                line = re.sub(r'\n+', r'<br>', line)
-            # Update progress
-            p += 1
-        # If sub file not found, index(root) will raise ValueError
-        except ValueError:
-            line = ''
-
-        # Fill fields
-        for field, option_idx in field_map.items():
-            data = ''
-            option = FILLING_OPTIONS[option_idx]
-            if option == FILL_NOTHING:
-                continue
-            elif option == FILL_FILENAME:
-                data = std_root
-            elif option == FILL_PROV:
-                data = prov
-            elif option == FILL_AUDIO:
-                data = u'[sound:%s]' % std_name
-            elif option == FILL_LINE:
-                data = line
-            elif option == FILL_IMAGE:
-                if std_image_files:
-                    image = random.choice(std_image_files)
-                    mw.col.media.addFile(image)
-                    data = u'<img src="%s">' % image
-            # Assign value to field
-            note[field] = data
-
-        # Add Tags
-        for tag in tags:
-            note.tags.append(tag)
-
-        # Add to collection
-        if not mw.col.addNote(note):
-            # No cards were generated - probably bad template. No point to import anymore.
-            is_import_failed = True
-            break
-        card_count += 1
-        p += 1
-
-        # Update progress
-        mw.progress.update(value=p)
-
-    # Delete std_image_files
-    for image in std_image_files:
-        os.remove(image)
+            # Create a note for each audio file, and add it to Anki collection
+            for i, (root, ext) in enumerate(audio_files):
+                std_root = std_prefix + '.audio-' + batch_id + '.' + str(i + 1)
+                # Write the audio straight into media under its standardized name, without an intermediate file.
+                # Media returns the name actually used, which differs if a different file already has that name.
+                with open(root + ext, 'rb') as f:
+                    std_name = mw.col.media.writeData(std_root + ext, f.read())
+
+                # Create a new note
+                note = notes.Note(mw.col, model)
+                note.model()['did'] = deck['id']
+
+                # Get subtitle file content
+                # Find the corespondent sub file
+                sub_ext = sub_files.get(root)
+                line = ''
+                if sub_ext is not None:
+                    if needs_line:
+                        line = _NEWLINES_RE.sub(r'<br>', _read_subtitle(root + sub_ext))
+                    # Update progress
+                    p += 1
+
+                # Fill fields
+                for field, filler in field_fillers:
+                    note[field] = filler()
+
+                # Add Tags
+                for tag in tags:
+                    note.tags.append(tag)
+
+                # Add to collection
+                if not mw.col.addNote(note):
+                    # No cards were generated - probably bad template. No point to import anymore.
+                    is_import_failed = True
+                    break
+                card_count += 1
+                p += 1
+
+                # Update progress
+                update_progress()
+        except BaseException:
+            # An error leaves the import incomplete, so add none of its notes
+            mw.col.rollback()
+            raise
+        # Fill the progress bar up to its maximum, as p misses subtitles without audio and files after a failure
+        mw.progress.update(value=len(entries))
+
+        # End the transaction: keep all new notes, or none of them if any failed.
+        # Media already added stays, as media may reuse an existing file with the same content that other notes use.
+        if is_import_failed:
+            mw.col.rollback()
+        else:
+            mw.col.save()
+    finally:
+        # Delete std_image_files
+        if staging_dir is not None:
+            rmtree(staging_dir, ignore_errors=True)
+        # Close the progress dialog, which would otherwise block Anki
+        mw.progress.finish()
 
     # At the end
-    mw.progress.finish()
     mw.deckBrowser.refresh()
     if is_import_failed:
         show_failure_dialog()
@@ -178,9 +326,13 @@ def show_failure_dialog():
     """
     QMessageBox.about(mw, "Lines Import Failure", """
 <p>
-Failed to generate one or more notes and no media files were imported. 
+Failed to generate one or more notes, so no notes were imported. 
 Please ensure the note type you selected is able to generate cards by using a valid card template.
 </p>
+<p>
+Media files added before the failure remain in collection.media. 
+Use <b>Tools > Check Media</b> to delete the ones no note uses.
+</p>
 """)
 
 
@@ -227,11 +379,16 @@ class SettingsDialog(QDialog):
             + '/settings@%s.json' % mw.pm.name.replace(' ', '.')
         settings_dict = {}
         try:
-            with open(self.SETTINGS_JSON_PATH) as f:
-                settings_dict = json.load(f)
+            if _is_settings_cached(self.SETTINGS_JSON_PATH):
+                settings_dict = _SETTINGS_CACHE['data']
+            else:
+                mtime = os.path.getmtime(self.SETTINGS_JSON_PATH)
+                with open(self.SETTINGS_JSON_PATH) as f:
+                    settings_dict = json.load(f)
+                _SETTINGS_CACHE.update(path=self.SETTINGS_JSON_PATH, mtime=mtime, data=settings_dict)
         except EnvironmentError:
-            logging.warning('Settings File Not Found.')
-        logging.info('The earlier settings: \n' + json.dumps(settings_dict))
+            logger.warning('Settings File Not Found.')
+        logger.info('The earlier settings: \n%s', _LazyJson(settings_dict))
         # dirPath (directory path, default: home path)
         self.dirPath = settings_dict.get(self.DIR_PATH_KEY, '')
         if not os.path.exists(self.dirPath):
@@ -258,8 +415,12 @@ class SettingsDialog(QDialog):
             self.modelName = mw.col.models.current()['name']
         self.form.modelCombo.setCurrentIndex(self.form.modelCombo.findText(self.modelName))
         self.form.modelCombo.currentIndexChanged.connect(self.model_updated)
+        self.fields = mw.col.models.byName(self.modelName)['flds']
         # fieldMap (field map, default: empty)
         self.fieldMap = settings_dict.get(self.FIELD_MAP_KEY, {})
+        # (QLabel, QComboBox) of each row in fieldMapGrid, kept for reuse when the model changes
+        self.gridRows = []
+        self.gridSpacer = QSpacerItem(0, 0, QSizePolicy.Minimum, QSizePolicy.Expanding)
         self.create_field_grid()
         # tags (default: [])
         self.tags = []
@@ -287,7 +448,7 @@ For how to use this add-on, please refer to
             return
         self.dirPath = path
         self.form.dirInput.setText(self.dirPath)
-        logging.info('dirPath =         ' + self.dirPath)
+        logger.info('dirPath =         ' + self.dirPath)
         self.prov = os.path.basename(self.dirPath)
         self.form.provInput.setText(self.prov)
 
@@ -296,21 +457,22 @@ For how to use this add-on, please refer to
         If user edit the content of provenance QLineEdit, change self.prov
         """
         self.prov = self.form.provInput.text()
-        logging.info('prov =            ' + self.prov)
+        logger.info('prov =            ' + self.prov)
 
     def deck_updated(self):
         """
         If user select another deck in combobox, change self.deckName
         """
         self.deckName = self.form.deckCombo.currentText()
-        logging.info('deckName =        ' + self.deckName)
+        logger.info('deckName =        ' + self.deckName)
 
     def model_updated(self):
         """
         If user select another model in combobox, change self.modelName
         """
         self.modelName = self.form.modelCombo.currentText()
-        logging.info('modelName =       ' + self.modelName)
+        logger.info('modelName =       ' + self.modelName)
+        self.fields = mw.col.models.byName(self.modelName)['flds'] if self.modelName else []
         self.create_field_grid()
 
     def tags_updated(self):
@@ -321,7 +483,7 @@ For how to use this add-on, please refer to
         self.tags = mw.col.tags.canonify(mw.col.tags.split(self.tagsTxt))
         self.tagsTxt = mw.col.tags.join(self.tags).strip()
         self.form.tagsInput.setText(self.tagsTxt)
-        logging.info('tags =            ' + self.tagsTxt)
+        logger.info('tags =            ' + self.tagsTxt)
 
     def create_field_grid(self):
         """
@@ -330,38 +492,38 @@ For how to use this add-on, please refer to
         Each row in the grid contains two columns:
         Column 0 = QLabel with name of field
         Column 1 = QComboBox with selection of mappings ("actions")
-        """
-        # Clear Grid layout
-        self.clear_layout(self.form.fieldMapGrid)
-        if not self.modelName:
-            return
 
-        # Add Combinations of QLabel (with field name) and QComboBox (with FILLING_OPTIONS) to QGridLayout
-        row = 0
-        for field in mw.col.models.byName(self.modelName)['flds']:
-            lbl = QLabel(field['name'])
-            cmb = QComboBox()
-            cmb.addItems(FILLING_OPTIONS)
+        Rows already in the grid are relabelled and reused, so only the difference
+        in number of fields is created or deleted.
+        """
+        grid = self.form.fieldMapGrid
+        # Take out the spacer, which goes below the last row
+        grid.removeItem(self.gridSpacer)
+
+        # Combinations of QLabel (with field name) and QComboBox (with FILLING_OPTIONS) in QGridLayout
+        for row, field in enumerate(self.fields):
+            if row < len(self.gridRows):
+                lbl, cmb = self.gridRows[row]
+            else:
+                lbl = QLabel()
+                cmb = QComboBox()
+                cmb.addItems(FILLING_OPTIONS)
+                grid.addWidget(lbl, row, 0)
+                grid.addWidget(cmb, row, 1)
+                self.gridRows.append((lbl, cmb))
+            lbl.setText(field['name'])
             cmb.setCurrentIndex(self.fieldMap.get(field['name'], -1))
-            # piggy-back the special flag on QLabel
-            self.form.fieldMapGrid.addWidget(lbl, row, 0)
-            self.form.fieldMapGrid.addWidget(cmb, row, 1)
 
-            row += 1
-        self.form.fieldMapGrid.addItem(
-            QSpacerItem(0, 0, QSizePolicy.Minimum, QSizePolicy.Expanding), row, 0)
-        logging.info("Fields Map of ** " + self.modelName + " ** are generated.")
+        # Delete rows left over from a model with more fields
+        for lbl, cmb in self.gridRows[len(self.fields):]:
+            for widget in (lbl, cmb):
+                grid.removeWidget(widget)
+                widget.deleteLater()
+        del self.gridRows[len(self.fields):]
 
-    def clear_layout(self, layout):
-        """
-        A recursive function, convenient for removing child widgets from a layout.
-        """
-        while layout.count():
-            child = layout.takeAt(0)
-            if child.widget() is not None:
-                child.widget().deleteLater()
-            elif child.layout() is not None:
-                self.clear_layout(child.layout())
+        grid.addItem(self.gridSpacer, len(self.fields), 0)
+        if self.modelName:
+            logger.info("Fields Map of ** " + self.modelName + " ** are generated.")
 
     def accept(self):
         """
@@ -400,22 +562,20 @@ If you choose 'No', provenance will be '%s'.
         # validate model
         if not self.modelName:
             self.modelName = mw.col.models.current()['name']
+            self.fields = mw.col.models.byName(self.modelName)['flds']
         # get field map
         self.fieldMap = {}
-        for row in range(len(mw.col.models.byName(self.modelName)['flds'])):
-            # QLabel with field name
-            field = self.form.fieldMapGrid.itemAtPosition(row, 0).widget().text()
-            # QComboBox with index from the FILLING_OPTIONS list
-            option_idx = self.form.fieldMapGrid.itemAtPosition(row, 1).widget().currentIndex()
-            self.fieldMap[field] = option_idx
+        for lbl, cmb in self.gridRows:
+            # QLabel with field name, and QComboBox with index from the FILLING_OPTIONS list, i.e. a Fill value
+            self.fieldMap[lbl.text()] = cmb.currentIndex()
 
         # logging
-        logging.info("Final dirPath   =     " + self.dirPath)
-        logging.info("Final prov      =     " + self.prov)
-        logging.info("Final deckName  =     " + self.deckName)
-        logging.info("Final modelName =     " + self.modelName)
-        logging.info('fieldMap = \n' + json.dumps(self.fieldMap, indent=4))
-        logging.info("Final tags =          " + self.tagsTxt)
+        logger.info("Final dirPath   =     " + self.dirPath)
+        logger.info("Final prov      =     " + self.prov)
+        logger.info("Final deckName  =     " + self.deckName)
+        logger.info("Final modelName =     " + self.modelName)
+        logger.info('fieldMap = \n%s', _LazyJson(self.fieldMap, indent=4))
+        logger.info("Final tags =          " + self.tagsTxt)
 
         # save user settings
         settings_dict = {
@@ -426,8 +586,13 @@ If you choose 'No', provenance will be '%s'.
             self.FIELD_MAP_KEY: self.fieldMap,
             self.TAGS_TXT_KEY: self.tagsTxt
         }
-        with open(self.SETTINGS_JSON_PATH, 'w') as f:
-            f.write(json.dumps(settings_dict, indent=4))
+        # skip writing if nothing changed since the settings were loaded
+        if not (_is_settings_cached(self.SETTINGS_JSON_PATH) and settings_dict == _SETTINGS_CACHE['data']):
+            with open(self.SETTINGS_JSON_PATH, 'w') as f:
+                json.dump(settings_dict, f, indent=4)
+            _SETTINGS_CACHE.update(path=self.SETTINGS_JSON_PATH,
+                                   mtime=os.path.getmtime(self.SETTINGS_JSON_PATH),
+                                   data=settings_dict)
 
         QDialog.accept(self)
 
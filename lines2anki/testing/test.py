@@ -11,12 +11,18 @@ import logging
 from PyQt5.QtWidgets import QAction
 from aqt import mw
 
+from .. import setup_logging
+
+
+logger = logging.getLogger(__name__)
+
 
 def do_test():
     """
     For testing convenience
     """
-    logging.info('Hello World!')
+    setup_logging()
+    logger.info('Hello World!')
 
 
 test_action = QAction("TEST", mw)